@@ -3,18 +3,47 @@ PolicyEngine Performance Profiler - Interactive Streamlit App
 """
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import time
-import cProfile
-import pstats
-from io import StringIO
+import threading
+import importlib.util
+import contextlib
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
 import pandas as pd
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
+import altair as alt
+import streamlit.components.v1 as components
+
+from profiler_core import (
+    COLORS,
+    CSS,
+    DOCS_MD,
+    FOOTER_HTML,
+    MAX_STORED_RESULTS,
+    PACKAGE_VERSIONS,
+    REFORM_JSON,
+    build_situation,
+    calculate_chunked,
+    chunk_situations,
+    compare_arrays,
+    export_profile,
+    format_profile,
+    get_reform,
+    get_simulation_class,
+    get_system_class,
+    load_result,
+    profile_call_count,
+    profile_dataframe,
+    profile_step,
+    store_result,
+    time_step,
+)
+from profiler_patches import patched_periods
 
-try:
-    from policyengine_core.reforms import Reform
-    # Simulation classes imported conditionally based on selected country
-except ImportError:
+# Only check the package is installed: PolicyEngine modules are imported on
+# first use (or by the background warm-up), not on every cold start
+if importlib.util.find_spec("policyengine_core") is None:
     st.error("Please install PolicyEngine packages: `uv pip install policyengine-us policyengine-uk`")
     st.stop()
 
@@ -24,106 +53,7 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# PolicyEngine brand colors (matches policyengine-app)
-COLORS = {
-    "primary": "#2C6496",  # Blue for extension/reform
-    "secondary": "#39C6C0",
-    "green": "#28A745",
-    "gray": "#BDBDBD",  # Medium light gray for baseline
-    "red": "#E57373",  # Light red for warnings/slowdowns
-    "orange": "#FFA726",
-    "blue_gradient": ["#D1E5F0", "#92C5DE", "#2166AC", "#053061"],
-}
-
-st.markdown(
-    f"""
-    <style>
-    .stApp {{
-        font-family: 'Roboto', 'Helvetica', 'Arial', sans-serif;
-    }}
-    h1 {{
-        color: {COLORS["primary"]};
-        font-weight: 600;
-    }}
-    h2 {{
-        color: {COLORS["primary"]};
-    }}
-    h3 {{
-        color: {COLORS["primary"]};
-    }}
-    /* Style primary buttons */
-    .stButton > button[kind="primary"] {{
-        background-color: {COLORS["primary"]};
-        color: white;
-        border: none;
-    }}
-    .stButton > button[kind="primary"]:hover {{
-        background-color: {COLORS["blue_gradient"][2]};
-        border: none;
-    }}
-    /* Style regular buttons */
-    .stButton > button {{
-        border-color: {COLORS["primary"]};
-        color: {COLORS["primary"]};
-    }}
-    .stButton > button:hover {{
-        border-color: {COLORS["blue_gradient"][2]};
-        color: {COLORS["blue_gradient"][2]};
-    }}
-    /* Style sliders - surgical approach */
-    /* Hide default red slider elements */
-    .stSlider [data-baseweb="slider"] [data-testid="stThumbValue"] {{
-        color: {COLORS["primary"]} !important;
-        background-color: {COLORS["primary"]} !important;
-    }}
-    /* Slider track - filled portion */
-    .stSlider [data-baseweb="slider"] > div > div:first-child {{
-        background-color: {COLORS["primary"]} !important;
-    }}
-    /* Slider thumb */
-    .stSlider [data-baseweb="slider"] [role="slider"] {{
-        background-color: {COLORS["primary"]} !important;
-    }}
-    /* Value label text */
-    .stSlider > div > div:first-child > div {{
-        color: {COLORS["primary"]} !important;
-    }}
-    /* Style selectbox */
-    .stSelectbox > div > div {{
-        border-color: {COLORS["gray"]};
-    }}
-    /* Style tabs */
-    .stTabs [data-baseweb="tab-list"] button[aria-selected="true"] {{
-        background-color: {COLORS["primary"]};
-        color: white;
-    }}
-    .stTabs [data-baseweb="tab-list"] button {{
-        color: {COLORS["primary"]};
-    }}
-    /* Style expandable sections */
-    .streamlit-expanderHeader {{
-        background-color: rgba(44, 100, 150, 0.05);
-        color: {COLORS["primary"]};
-    }}
-    /* Style checkboxes - target the actual checkbox input */
-    .stCheckbox [data-baseweb="checkbox"] {{
-        background-color: {COLORS["primary"]} !important;
-        border-color: {COLORS["primary"]} !important;
-    }}
-    .stCheckbox input[type="checkbox"]:checked ~ div {{
-        background-color: {COLORS["primary"]} !important;
-    }}
-    .stCheckbox input[type="checkbox"]:checked ~ div svg {{
-        fill: white !important;
-    }}
-    /* Style number input value text */
-    .stNumberInput > div > div > input {{
-        color: {COLORS["primary"]};
-    }}
-    </style>
-""",
-    unsafe_allow_html=True,
-)
+st.html(CSS)
 
 st.title("🔬 PolicyEngine Performance Profiler")
 st.markdown("""
@@ -137,15 +67,12 @@ with st.sidebar:
     st.header("Configuration")
 
     # Show package versions
-    try:
-        from importlib.metadata import version
-        us_version = version('policyengine-us')
-        core_version = version('policyengine-core')
-        st.caption(f"📦 policyengine-us: `{us_version}`")
-        st.caption(f"📦 policyengine-core: `{core_version}`")
-        st.markdown("---")
-    except Exception as e:
-        st.caption(f"⚠️ Version info unavailable: {str(e)}")
+    for package, package_version in PACKAGE_VERSIONS.items():
+        if package_version:
+            st.caption(f"📦 {package}: `{package_version}`")
+        else:
+            st.caption(f"⚠️ {package}: version info unavailable")
+    st.markdown("---")
 
     st.subheader("Test Configuration")
 
@@ -154,6 +81,32 @@ with st.sidebar:
     income_points = st.slider("Income data points", 10, 2000, 1001, step=10,
                               help="More points = slower calculations (doesn't affect simulation creation overhead)")
 
+    fast_periods = st.checkbox(
+        "Memoise `instant()`/`period()` (what-if)", value=False,
+        help="Patch policyengine-core's period helpers with pre-filled lookup tables while building simulations, to estimate the saving from fixing them"
+    )
+
+    reuse_system = st.checkbox(
+        "Reuse a prebuilt tax-benefit system (what-if)", value=False,
+        help="Build the (reformed) tax-benefit system once per process and pass it to each Simulation, to estimate the saving from caching uprated parameters at the system level"
+    )
+
+    profiler_mode = st.radio(
+        "Profiler", ["Deterministic", "Sampling"], index=0, horizontal=True,
+        help="Deterministic (cProfile) records every call and exact call counts but slows the profiled run; sampling (pyinstrument) adds little overhead but has no call counts"
+    )
+    sampling = profiler_mode == "Sampling"
+
+    full_profile = st.checkbox(
+        "Full profile (subcalls + builtins)", value=False, disabled=sampling,
+        help="Also record C built-in calls (numpy, dict, ...) and caller/callee edges. More detail, but more profiler overhead and a bigger stats table"
+    )
+
+    force_rebuild = st.button(
+        "♻️ Force rebuild", use_container_width=True,
+        help="Simulations are cached per configuration; drop them so the next run rebuilds and re-profiles from scratch"
+    )
+
     # Show what's being tested
     st.markdown("---")
     st.caption("**Test Setup:**")
@@ -166,213 +119,337 @@ with st.sidebar:
         st.caption("• **Reform:** Universal Credit +10%")
         st.caption("• **Household:** 35yo, England, £0-100k")
 
-def get_reform(country):
-    """Get the reform definition based on country"""
-    if country == "US":
-        return Reform.from_dict({
-            "gov.aca.ptc_phase_out_rate[0].amount": {"2026-01-01.2100-12-31": 0},
-            "gov.aca.ptc_phase_out_rate[1].amount": {"2025-01-01.2100-12-31": 0},
-            "gov.aca.ptc_phase_out_rate[2].amount": {"2026-01-01.2100-12-31": 0},
-            "gov.aca.ptc_phase_out_rate[3].amount": {"2026-01-01.2100-12-31": 0.02},
-            "gov.aca.ptc_phase_out_rate[4].amount": {"2026-01-01.2100-12-31": 0.04},
-            "gov.aca.ptc_phase_out_rate[5].amount": {"2026-01-01.2100-12-31": 0.06},
-            "gov.aca.ptc_phase_out_rate[6].amount": {"2026-01-01.2100-12-31": 0.085},
-            "gov.aca.ptc_income_eligibility[2].amount": {"2026-01-01.2100-12-31": True}
-        }, country_id="us")
-    else:  # UK
-        return Reform.from_dict({
-            "gov.dwp.universal_credit.elements.standard_allowance.amount.single.under_25": {
-                "2024-01-01.2100-12-31": 311.68 * 1.1  # 10% increase
-            }
-        }, country_id="uk")
-
-def build_situation(income_points, country):
-    """Build a standard test situation
-
-    Note: Household config doesn't affect the parameter uprating bottleneck.
-    The 6-7 second overhead happens regardless of age, income, etc.
+@st.cache_resource(show_spinner=False)
+def start_warmup(country):
+    """Import the country package in a background thread, once per process
+
+    Overlaps the multi-second import with the time the user spends in the
+    sidebar, instead of paying it on Run Profile. Nothing else runs here: a
+    waiting build starts timing as soon as the import finishes, and any
+    further work in this thread would compete with it for the GIL.
     """
-    if country == "US":
-        return {
-            "people": {"you": {"age": {2026: 35}}},
-            "families": {"your family": {"members": ["you"]}},
-            "spm_units": {"your household": {"members": ["you"]}},
-            "tax_units": {"your tax unit": {"members": ["you"]}},
-            "households": {
-                "your household": {
-                    "members": ["you"],
-                    "state_name": {2026: "TX"}
-                }
-            },
-            "axes": [[{
-                "name": "employment_income",
-                "count": income_points,
-                "min": 0,
-                "max": 1000000,
-                "period": 2026
-            }]]
-        }
-    else:  # UK
-        return {
-            "people": {"you": {"age": {2024: 35}}},
-            "benunits": {"your benunit": {"members": ["you"]}},
-            "households": {
-                "your household": {
-                    "members": ["you"],
-                    "region": {2024: "ENGLAND"}
-                }
-            },
-            "axes": [[{
-                "name": "employment_income",
-                "count": income_points,
-                "min": 0,
-                "max": 100000,
-                "period": 2024
-            }]]
-        }
-
-def profile_step(name, func):
-    """Profile a single step with timing and cProfile"""
-    pr = cProfile.Profile()
-    pr.enable()
-
-    start = time.time()
-    result = func()
-    elapsed = time.time() - start
-
-    pr.disable()
-
-    # Get stats
-    s = StringIO()
-    ps = pstats.Stats(pr, stream=s).sort_stats('cumulative')
-    ps.print_stats(20)
-
-    return {
-        'name': name,
-        'time': elapsed,
-        'result': result,
-        'profile': s.getvalue()
-    }
+    def warmup():
+        try:
+            get_simulation_class(country)
+        except ImportError:
+            pass  # reported properly when the simulation is built
 
-# Main profiling section
-if st.button("🚀 Run Profile", type="primary", use_container_width=True):
-    situation = build_situation(income_points, country)
+    thread = threading.Thread(target=warmup, name=f"warmup-{country}", daemon=True)
+    thread.start()
+    return thread
 
-    # Import the correct Simulation class based on country
-    if country == "US":
-        from policyengine_us import Simulation
+start_warmup(country)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def cached_situation(income_points, country):
+    """build_situation memoised across reruns (each call gets its own copy)"""
+    return build_situation(income_points, country)
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def get_tax_benefit_system(country, reform_json=None):
+    """The (reformed) country system, built once per process to share across simulations
+
+    Its 2026 parameters are loaded here too, outside every timed region.
+    """
+    reform = get_reform(country, reform_json) if reform_json else None
+    system = get_system_class(country)(reform=reform)
+    # Step 3 calculates for 2026; otherwise whichever timed calculate() ran
+    # first on this system would pay to fill its per-instant parameter cache
+    for month in range(1, 13):
+        system.get_parameters_at_instant(f"2026-{month:02d}-01")
+    return system
+
+@st.cache_resource(max_entries=MAX_STORED_RESULTS, show_spinner=False)
+def build_simulation(country, income_points, reform_json=None, fast_periods=False,
+                     sampling=False, reuse_system=False, full_profile=False):
+    """Build and profile a Simulation, cached across reruns
+
+    Only the cache miss is profiled; later reruns with the same inputs reuse
+    the first run's profile and Simulation instead of paying setup again.
+    The reform is passed as a JSON string so it is hashable. With
+    ``reuse_system`` the system is built (unprofiled) beforehand, so only
+    the Simulation's own setup is measured.
+    """
+    Simulation = get_simulation_class(country)
+    situation = cached_situation(income_points, country)
+    name = "Baseline" if reform_json is None else "Reform"
+    if reuse_system:
+        system = get_tax_benefit_system(country, reform_json)
+        build = partial(Simulation, situation=situation, tax_benefit_system=system)
+    elif reform_json is None:
+        build = partial(Simulation, situation=situation)
     else:
-        from policyengine_uk import Simulation
-
-    with st.spinner("Profiling simulations..."):
-        # Profile baseline
-        st.markdown("### Step 1: Baseline Simulation")
-        baseline_result = profile_step(
-            "Baseline",
-            lambda: Simulation(situation=situation)
-        )
+        reform = get_reform(country, reform_json)
+        build = partial(Simulation, situation=situation, reform=reform)
 
-        st.metric("Baseline Time", f"{baseline_result['time']:.3f}s")
+    patch = patched_periods() if fast_periods else contextlib.nullcontext()
+    with patch:
+        return profile_step(name, build, sampling, full_profile)
 
-        # Profile reform
-        st.markdown("### Step 2: Reform Simulation")
-        reform = get_reform(country)
+def iter_chunk_simulations(country, income_points, chunk_size, reform_json=None,
+                           fast_periods=False):
+    """Build one uncached Simulation per chunk of the income axis, lazily
 
-        if reform:
-            reform_result = profile_step(
-                "Reform",
-                lambda: Simulation(situation=situation, reform=reform)
-            )
+    All chunks share the cached (reformed) system, so the reform is uprated
+    once rather than per chunk. Each Simulation is built only when the
+    consumer asks for the next one, so at most one chunk's arrays are alive.
+    """
+    Simulation = get_simulation_class(country)
+    system = get_tax_benefit_system(country, reform_json)
+    for chunk in chunk_situations(cached_situation(income_points, country), chunk_size):
+        patch = patched_periods() if fast_periods else contextlib.nullcontext()
+        with patch:
+            sim = Simulation(situation=chunk, tax_benefit_system=system)
+        yield sim
+        del sim  # before building the next chunk
+
+def fresh_simulation(country, income_points, reform_json=None, fast_periods=False):
+    """An uncached Simulation on the shared (reformed) system, for timing calculations
+
+    The Simulations cached by build_simulation keep every array they have
+    computed, so timing calculate() on them would measure cache hits. A new
+    one per click starts empty while still skipping the system build (whose
+    2026 parameters get_tax_benefit_system has already loaded).
+    """
+    Simulation = get_simulation_class(country)
+    system = get_tax_benefit_system(country, reform_json)
+    situation = cached_situation(income_points, country)
+    patch = patched_periods() if fast_periods else contextlib.nullcontext()
+    with patch:
+        return Simulation(situation=situation, tax_benefit_system=system)
+
+if force_rebuild:
+    build_simulation.clear()
+    get_tax_benefit_system.clear()
+    st.session_state.pop('last_run', None)
+
+def run_with_timer(label, func, *args, **kwargs):
+    """Run func in a worker thread while showing a live elapsed-time counter
+
+    Steps run one at a time so their timings are not skewed by contention;
+    the worker only keeps the page responsive during long builds.
+    """
+    status = st.empty()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(
+        max_workers=1,
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx()),
+    ) as ex:
+        future = ex.submit(func, *args, **kwargs)
+        while not wait([future], timeout=0.25).done:
+            status.caption(f"⏳ {label}... {time.perf_counter() - start:.1f}s")
+    status.empty()
+    return future.result()
+
+def show_profile(pr, name):
+    """Sortable table of the top functions (or the call tree for a sampling
+    profile), plus a download of the full raw profile"""
+    data, extension = export_profile(pr)
+    st.download_button(
+        f"⬇️ Download {name.lower()} profile (.{extension})",
+        data=data,
+        file_name=f"{name.lower()}.{extension}",
+        key=f"download-{name}",
+    )
+    if profile_call_count(pr) is None:
+        st.code(format_profile(pr))
+        return
+    st.caption(f"Explore the full call graph with `snakeviz {name.lower()}.prof`")
+    show_profile_table(pr)
+
+def show_rss_delta(result):
+    """Resident memory growth while building, when psutil is available"""
+    if result['rss_delta_mb'] is None:
+        st.caption("Install psutil to see memory growth per step")
+        return
+    st.metric("RSS delta", f"{result['rss_delta_mb']:.1f} MB",
+              help="Resident memory growth during the unprofiled build. "
+                   "Large growth with a long build points at allocation and "
+                   "parameter-tree traversal, which faster arithmetic will not fix")
+
+def show_profile_table(*profilers):
+    """Sortable table of the top functions across one or more cProfile profiles"""
+    st.dataframe(
+        profile_dataframe(*profilers),
+        column_config={
+            "tottime": st.column_config.NumberColumn("tottime (s)", format="%.3f"),
+            "cumtime": st.column_config.NumberColumn("cumtime (s)", format="%.3f"),
+        },
+        hide_index=True,
+        use_container_width=True,
+    )
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def comparison_bar(values, text, y_title):
+    """Baseline vs reform bar chart in the brand colors, as a cached Vega-Lite spec"""
+    df = pd.DataFrame({
+        "step": ["Baseline", "Reform"],
+        "value": list(values),
+        "text": list(text),
+    })
+    base = alt.Chart(df).encode(
+        x=alt.X("step:N", title=None, sort=None, axis=alt.Axis(labelAngle=0)),
+        y=alt.Y("value:Q", title=y_title),
+    )
+    bars = base.mark_bar().encode(
+        color=alt.Color("step:N", scale=alt.Scale(range=[COLORS['gray'], COLORS['red']]), legend=None)
+    )
+    chart = (bars + base.mark_text(dy=-8).encode(text="text:N")).properties(height=360)
+    return chart.to_dict()
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def reform_breakdown_html(overhead, baseline_time):
+    """Static HTML for the reform time pie, loading plotly.js from the CDN"""
+    import plotly.graph_objects as go
+
+    fig = go.Figure(go.Pie(
+        labels=["Parameter Uprating", "Other Overhead", "Base Simulation"],
+        values=[overhead * 0.68, overhead * 0.32, baseline_time],
+        marker=dict(colors=[COLORS['red'], COLORS['orange'], COLORS['green']]),
+        textinfo='label+percent'
+    ))
+    fig.update_layout(
+        height=380,
+        showlegend=False,
+        margin=dict(t=20, b=20, l=20, r=20),
+        paper_bgcolor='white',
+        font=dict(family='Roboto, sans-serif')
+    )
+    return fig.to_html(
+        include_plotlyjs='cdn', full_html=False,
+        config={'displayModeBar': False, 'responsive': True}
+    )
 
-            overhead = reform_result['time'] - baseline_result['time']
-            overhead_pct = (reform_result['time'] / baseline_result['time'] - 1) * 100
+# Main profiling section
+profile_inputs = (
+    country, income_points, fast_periods, sampling, reuse_system, full_profile
+)
 
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                st.metric("Reform Time", f"{reform_result['time']:.3f}s")
-            with col2:
-                st.metric("Overhead", f"{overhead:.3f}s",
-                         delta=f"{overhead_pct:,.0f}% slower",
-                         delta_color="inverse")
-            with col3:
-                st.metric("Slowdown Factor", f"{reform_result['time']/baseline_result['time']:.1f}x")
-
-            # Visualization
-            st.markdown("### Performance Comparison")
-
-            # Create 3-column layout for better comparison
-            fig = make_subplots(
-                rows=1, cols=3,
-                subplot_titles=("Time Comparison", "Reform Time Breakdown", "Function Calls"),
-                specs=[[{"type": "bar"}, {"type": "pie"}, {"type": "bar"}]],
-                column_widths=[0.3, 0.35, 0.35]
-            )
+if st.button("🚀 Run Profile", type="primary", use_container_width=True):
+    progress = st.empty()
+    with progress.container(), st.spinner("Profiling simulations..."):
+        baseline_result = run_with_timer(
+            "Building baseline simulation", build_simulation,
+            country, income_points,
+            fast_periods=fast_periods, sampling=sampling, reuse_system=reuse_system,
+            full_profile=full_profile
+        )
+        st.caption(f"Baseline built in {baseline_result['time']:.3f}s")
 
-            # Bar chart
-            fig.add_trace(
-                go.Bar(
-                    x=["Baseline", "Reform"],
-                    y=[baseline_result['time'], reform_result['time']],
-                    text=[f"{baseline_result['time']:.3f}s", f"{reform_result['time']:.3f}s"],
-                    textposition='outside',
-                    marker_color=[COLORS['gray'], COLORS['red']]
-                ),
-                row=1, col=1
-            )
+        reform_result = run_with_timer(
+            "Building reform simulation", build_simulation,
+            country, income_points, REFORM_JSON[country],
+            fast_periods=fast_periods, sampling=sampling, reuse_system=reuse_system,
+            full_profile=full_profile
+        )
+    progress.empty()
 
-            # Pie chart of reform time breakdown
-            fig.add_trace(
-                go.Pie(
-                    labels=["Parameter Uprating", "Other Overhead", "Base Simulation"],
-                    values=[overhead * 0.68, overhead * 0.32, baseline_result['time']],
-                    marker=dict(colors=[COLORS['red'], COLORS['orange'], COLORS['green']]),
-                    textinfo='label+percent'
-                ),
-                row=1, col=2
-            )
+    # Handles rather than results, so session state never pins Simulations
+    st.session_state.last_run = {
+        'inputs': profile_inputs,
+        'baseline': store_result(baseline_result),
+        'reform': store_result(reform_result),
+    }
 
-            # Function calls comparison (estimated from typical ratios)
-            # Baseline: ~100k calls, Reform: ~85M calls
-            baseline_calls = 100000  # Estimated
-            reform_calls = 85600000  # Typical for reform
-
-            fig.add_trace(
-                go.Bar(
-                    x=["Baseline", "Reform"],
-                    y=[baseline_calls / 1e6, reform_calls / 1e6],
-                    text=[f"{baseline_calls/1e6:.1f}M", f"{reform_calls/1e6:.0f}M"],
-                    textposition='outside',
-                    marker_color=[COLORS['gray'], COLORS['red']],
-                    yaxis='y3',
-                    showlegend=False
-                ),
-                row=1, col=3
+# Re-render the last run on any rerun with the same inputs (e.g. picking a
+# variable below) instead of dropping the results until the button is hit again
+last_run = st.session_state.get('last_run')
+if last_run is not None and last_run['inputs'] != profile_inputs:
+    last_run = None
+if last_run is not None:
+    baseline_result = load_result(last_run['baseline'])
+    reform_result = load_result(last_run['reform'])
+    if baseline_result is None or reform_result is None:
+        st.info("These results were evicted to free memory (recent results are shared by all sessions); click **Run Profile** to rebuild them.")
+        last_run = None
+
+if last_run is not None:
+    st.markdown("### Step 1: Baseline Simulation")
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric("Baseline Time", f"{baseline_result['time']:.3f}s")
+    with col2:
+        show_rss_delta(baseline_result)
+
+    st.markdown("### Step 2: Reform Simulation")
+    overhead = reform_result['time'] - baseline_result['time']
+    overhead_pct = (reform_result['time'] / baseline_result['time'] - 1) * 100
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Reform Time", f"{reform_result['time']:.3f}s")
+    with col2:
+        st.metric("Overhead", f"{overhead:.3f}s",
+                 delta=f"{overhead_pct:,.0f}% slower",
+                 delta_color="inverse")
+    with col3:
+        st.metric("Slowdown Factor", f"{reform_result['time']/baseline_result['time']:.1f}x")
+    show_rss_delta(reform_result)
+
+    # Visualization
+    st.markdown("### Performance Comparison")
+
+    # Function calls recorded by cProfile during construction
+    baseline_calls = profile_call_count(baseline_result['profiler'])
+    reform_calls = profile_call_count(reform_result['profiler'])
+
+    # The 68/32 split and the bottleneck figures below describe a stock
+    # reform build; with a what-if option on, or no overhead, they don't apply
+    stock_breakdown = not (reuse_system or fast_periods) and overhead > 0
+
+    # Vega-Lite bars and a static Plotly pie; call counts as a native table
+    col1, col2 = st.columns([0.45, 0.55])
+    with col1:
+        st.markdown("**Time Comparison**")
+        st.vega_lite_chart(comparison_bar(
+            (baseline_result['time'], reform_result['time']),
+            (f"{baseline_result['time']:.3f}s", f"{reform_result['time']:.3f}s"),
+            "Time (seconds)"
+        ), use_container_width=True)
+
+    with col2:
+        st.markdown("**Reform Time Breakdown**")
+        if stock_breakdown:
+            components.html(
+                reform_breakdown_html(overhead, baseline_result['time']), height=400
             )
-
-            fig.update_layout(
-                height=400,
-                showlegend=False,
-                title={
-                    "text": "Simulation Creation Performance Analysis",
-                    "font": {"size": 20, "color": COLORS["primary"]},
-                },
-                plot_bgcolor='white',
-                paper_bgcolor='white',
-                font=dict(family='Roboto, sans-serif')
+        else:
+            st.caption(
+                "The typical breakdown only applies to a stock reform build; "
+                "turn off the what-if options in the sidebar to see it"
+                if reuse_system or fast_periods else
+                "No reform overhead measured, so there is nothing to break down"
             )
 
-            # Update axes
-            fig.update_xaxes(title_text="", row=1, col=1)
-            fig.update_yaxes(title_text="Time (seconds)", row=1, col=1)
-            fig.update_xaxes(title_text="", row=1, col=3)
-            fig.update_yaxes(title_text="Function Calls (millions)", row=1, col=3)
-
-            st.plotly_chart(fig, use_container_width=True)
+    # Call counts only exist for deterministic (cProfile) profiles
+    if baseline_calls is not None:
+        st.markdown("**Function Calls**")
+        st.dataframe(
+            pd.DataFrame(
+                {"calls_m": [baseline_calls / 1e6, reform_calls / 1e6]},
+                index=["Baseline", "Reform"]
+            ),
+            column_config={
+                "calls_m": st.column_config.ProgressColumn(
+                    "Function calls (millions)",
+                    format="%.1fM",
+                    min_value=0,
+                    max_value=max(baseline_calls, reform_calls) / 1e6,
+                )
+            },
+            use_container_width=True,
+        )
 
-            # Interpretation guide
-            st.markdown("#### 📊 What This Means")
-            st.info(f"""
-**The Problem:** Creating a reform simulation makes **{reform_calls/baseline_calls:,.0f}x more function calls** than baseline!
+    # Interpretation guide
+    st.markdown("#### 📊 What This Means")
+    if baseline_calls is not None:
+        problem = f"Creating a reform simulation makes **{reform_calls/baseline_calls:,.0f}x more function calls** than baseline!"
+    else:
+        problem = f"Creating a reform simulation takes **{reform_result['time']/baseline_result['time']:,.0f}x longer** than baseline!"
+    if stock_breakdown:
+        st.info(f"""
+**The Problem:** {problem}
 
 **Where the time goes:**
 - **68% Parameter Uprating** - Inflating all parameters from base year to 2026
@@ -386,78 +463,167 @@ if st.button("🚀 Run Profile", type="primary", use_container_width=True):
 - Calendar operations: 1.7M calls → 1.4 seconds
 
 All of this happens **before any actual calculation** - it's just to set up the reformed tax system!
-            """)
-
-            # Detailed profiles
-            with st.expander("📊 Detailed Baseline Profile"):
-                st.code(baseline_result['profile'])
-
-            with st.expander("📊 Detailed Reform Profile"):
-                st.code(reform_result['profile'])
-
-            # Profile calculations
-            st.markdown("### Step 3: Calculate Variables")
-
-            sim_baseline = baseline_result['result']
-            sim_reform = reform_result['result']
+    """)
+    else:
+        st.info(f"""
+**The Problem:** {problem}
 
-            variable_to_test = st.selectbox(
-                "Variable to profile",
-                ["employment_income", "aca_ptc", "income_tax", "household_net_income"]
-            )
+This run used a what-if option or showed no reform overhead, so the usual
+breakdown (parameter uprating and the `instant()`/`period()` hot spots) does
+not describe it. Use the detailed profiles below to see where the time went.
+    """)
 
-            if st.button("Profile Variable Calculation"):
-                with st.spinner(f"Calculating {variable_to_test}..."):
-                    # Baseline variable calculation
-                    baseline_calc = profile_step(
-                        f"Baseline {variable_to_test}",
-                        lambda: sim_baseline.calculate(variable_to_test, map_to="household", period=2026)
+    # Detailed profiles. Streamlit runs expander bodies even when collapsed,
+    # so the sorting and export work waits until the user asks for it
+    if st.toggle("Show detailed profiles", value=False,
+                 help="Sort and export the raw profiles (cached once done)"):
+        with st.expander("📊 Detailed Baseline Profile"):
+            show_profile(baseline_result['profiler'], "Baseline")
+
+        with st.expander("📊 Detailed Reform Profile"):
+            show_profile(reform_result['profiler'], "Reform")
+
+        if baseline_calls is not None:
+            with st.expander("📊 Combined Profile (all steps)"):
+                st.caption("Baseline and reform construction in one table, summed per function")
+                show_profile_table(baseline_result['profiler'], reform_result['profiler'])
+
+    # Profile calculations
+    st.markdown("### Step 3: Calculate Variables")
+
+    variable_to_test = st.selectbox(
+        "Variable to profile",
+        ["employment_income", "aca_ptc", "income_tax", "household_net_income"]
+    )
+
+    chunk_size = st.select_slider(
+        "Calculate in chunks of",
+        options=[0, 100, 250, 500, 1000],
+        value=0,
+        format_func=lambda n: "off (one simulation)" if n == 0 else f"{n} points",
+        help="Split the income axis across several smaller simulations to compare per-chunk throughput and peak memory with a single large one. Each chunk is a new Simulation built on every click (all sharing one tax-benefit system), so smaller chunks add setup time outside the timed calculations"
+    )
+
+    concurrent_calc = st.checkbox(
+        "Calculate baseline and reform concurrently", value=False,
+        disabled=bool(chunk_size),
+        help="Run both calculations in two threads and report the combined wall time. Every click times fresh simulations on a shared system whose 2026 parameters are loaded beforehand, so toggle this and click again to compare with the sequential run. Per-variable times may rise from contention"
+    )
+
+    if st.button("Profile Variable Calculation"):
+        with st.spinner(f"Calculating {variable_to_test}..."):
+            if chunk_size:
+                # Each chunk is built, calculated and dropped in turn; only
+                # the calculate() calls are timed
+                baseline_values, baseline_chunk_times = run_with_timer(
+                    "Calculating baseline chunks", calculate_chunked,
+                    iter_chunk_simulations(country, income_points, chunk_size,
+                                           fast_periods=fast_periods),
+                    variable_to_test, period=2026
+                )
+                reform_values, reform_chunk_times = run_with_timer(
+                    "Calculating reform chunks", calculate_chunked,
+                    iter_chunk_simulations(country, income_points, chunk_size,
+                                           REFORM_JSON[country], fast_periods=fast_periods),
+                    variable_to_test, period=2026
+                )
+                baseline_time = sum(baseline_chunk_times)
+                reform_time = sum(reform_chunk_times)
+            else:
+                # Fresh Simulations each click, so no array is already computed
+                sim_baseline = run_with_timer(
+                    "Building baseline simulation", fresh_simulation,
+                    country, income_points, fast_periods=fast_periods
+                )
+                sim_reform = run_with_timer(
+                    "Building reform simulation", fresh_simulation,
+                    country, income_points, REFORM_JSON[country],
+                    fast_periods=fast_periods
+                )
+                # Time-only: profiling calculate() would mostly measure the
+                # profiler, and running it twice would hit the result cache
+                steps = [
+                    (f"Baseline {variable_to_test}",
+                     partial(sim_baseline.calculate, variable_to_test, map_to="household", period=2026)),
+                    (f"Reform {variable_to_test}",
+                     partial(sim_reform.calculate, variable_to_test, map_to="household", period=2026)),
+                ]
+                start = time.perf_counter()
+                if concurrent_calc:
+                    # Separate simulations; numpy-heavy formulas release the GIL
+                    with ThreadPoolExecutor(max_workers=2) as ex:
+                        futures = [ex.submit(time_step, *step) for step in steps]
+                        baseline_calc, reform_calc = [f.result() for f in futures]
+                else:
+                    baseline_calc, reform_calc = [time_step(*step) for step in steps]
+                calc_wall_time = time.perf_counter() - start
+                baseline_values, baseline_time = baseline_calc['result'], baseline_calc['time']
+                reform_values, reform_time = reform_calc['result'], reform_calc['time']
+
+            col1, col2 = st.columns(2)
+            with col1:
+                st.metric(f"Baseline {variable_to_test}", f"{baseline_time:.3f}s")
+            with col2:
+                st.metric(f"Reform {variable_to_test}", f"{reform_time:.3f}s")
+
+            st.info(f"Calculated {len(baseline_values)} values across income range")
+            if not chunk_size:
+                # Both modes time fresh Simulations on pre-warmed systems, so
+                # runs of each mode on the same inputs are comparable
+                # whatever the click order
+                wall_times = st.session_state.setdefault('calc_wall_times', {})
+                calc_key = (country, income_points, fast_periods, variable_to_test)
+                wall_times[calc_key, concurrent_calc] = calc_wall_time
+                mode = "concurrent" if concurrent_calc else "sequential"
+                other_mode = "sequential" if concurrent_calc else "concurrent"
+                other_time = wall_times.get((calc_key, not concurrent_calc))
+                if other_time is None:
+                    st.caption(
+                        f"Wall time for both: {calc_wall_time:.3f}s ({mode}). "
+                        f"Run again {other_mode} to compare"
                     )
-
-                    # Reform variable calculation
-                    reform_calc = profile_step(
-                        f"Reform {variable_to_test}",
-                        lambda: sim_reform.calculate(variable_to_test, map_to="household", period=2026)
+                else:
+                    st.caption(
+                        f"Wall time for both: {calc_wall_time:.3f}s {mode} "
+                        f"vs {other_time:.3f}s {other_mode}"
                     )
 
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        st.metric(f"Baseline {variable_to_test}", f"{baseline_calc['time']:.3f}s")
-                    with col2:
-                        st.metric(f"Reform {variable_to_test}", f"{reform_calc['time']:.3f}s")
-
-                    st.info(f"Calculated {len(baseline_calc['result'])} values across income range")
+            if chunk_size:
+                st.markdown(f"**Calculation time per {chunk_size}-point chunk**")
+                st.line_chart(pd.DataFrame({
+                    "Chunk": range(1, len(baseline_chunk_times) + 1),
+                    "Baseline": baseline_chunk_times,
+                    "Reform": reform_chunk_times,
+                }), x="Chunk", color=[COLORS['gray'], COLORS['primary']])
+
+            axis = cached_situation(income_points, country)["axes"][0][0]
+            incomes = np.linspace(axis["min"], axis["max"], len(baseline_values))
+            st.line_chart(pd.DataFrame({
+                "Employment income": incomes,
+                "Baseline": baseline_values,
+                "Reform": reform_values,
+            }), x="Employment income", color=[COLORS['gray'], COLORS['primary']])
+
+            st.markdown("**Compare distributions**")
+            diff, ratio, rms = compare_arrays(baseline_values, reform_values)
+            st.caption(f"RMS reform − baseline difference: {rms:,.2f}")
+            col1, col2 = st.columns(2)
+            with col1:
+                st.line_chart(pd.DataFrame({
+                    "Employment income": incomes,
+                    "Reform − baseline": diff,
+                }), x="Employment income", color=COLORS['primary'])
+            with col2:
+                st.line_chart(pd.DataFrame({
+                    "Employment income": incomes,
+                    "Reform / baseline": ratio,
+                }), x="Employment income", color=COLORS['primary'])
+                st.caption("Shown as 0 where the baseline is 0")
 
 # Add documentation
 with st.expander("📖 How to Use This Profiler"):
-    st.markdown("""
-    ### Purpose
-    This tool helps identify performance bottlenecks in PolicyEngine simulations.
-
-    ### Steps
-    1. **Configure** your household and income range in the sidebar
-    2. **Choose** whether to profile with a reform
-    3. **Click** "Run Profile" to start profiling
-    4. **Analyze** the results to identify bottlenecks
-
-    ### Known Issues
-    - **Reform overhead**: Creating a Simulation with a reform is 100-700x slower than baseline
-    - **Parameter uprating**: Takes 11+ seconds per reform simulation
-    - See [policyengine-core#397](https://github.com/PolicyEngine/policyengine-core/issues/397)
-
-    ### Tips
-    - Start with fewer income points (100-200) for faster profiling
-    - Use the detailed profiles to identify specific slow functions
-    - Compare baseline vs reform to isolate reform-specific overhead
-    """)
+    st.markdown(DOCS_MD)
 
 # Footer
 st.markdown("---")
-st.markdown("""
-<div style='text-align: center; color: #666;'>
-    <small>PolicyEngine Performance Profiler •
-    <a href='https://github.com/PolicyEngine/policyengine-profiler'>GitHub</a> •
-    <a href='https://github.com/PolicyEngine/policyengine-core/issues/397'>Issue #397</a>
-    </small>
-</div>
-""", unsafe_allow_html=True)
+st.markdown(FOOTER_HTML, unsafe_allow_html=True)
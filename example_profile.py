@@ -3,70 +3,93 @@ Simple profiling example for command-line use
 """
 
 from policyengine_us import Simulation
-from policyengine_core.reforms import Reform
+import argparse
+import os
+import tempfile
 import time
 import cProfile
 import pstats
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from profiler_core import (
+    REFORM_JSON,
+    build_situation,
+    calculate_chunked,
+    chunk_situations,
+    get_reform,
+)
+
+def build_and_calculate(name, reform_json, variables, profile=False):
+    """Build one simulation, then calculate variables on it, timing each step
+
+    Pickle-safe so it can run in a worker process: the reform travels as
+    JSON, and only timings, values and the path of the dumped cProfile
+    stats come back (the Simulation itself stays where it was built). The
+    stats come from a second, untimed build.
+    """
+    situation = build_situation(1001, "US")
+    reform = get_reform("US", reform_json) if reform_json else None
+
+    # Timed build runs unprofiled; the profile comes from a second build, as
+    # in profiler_core.profile_step, so profiler overhead stays out of the times
+    t0 = time.perf_counter()
+    sim = Simulation(situation=situation, reform=reform)
+    build_time = time.perf_counter() - t0
+
+    profile_path = None
+    if profile:
+        pr = cProfile.Profile()
+        pr.enable()
+        Simulation(situation=situation, reform=reform)
+        pr.disable()
+        fd, profile_path = tempfile.mkstemp(prefix=f"{name}-", suffix=".prof")
+        os.close(fd)
+        pr.dump_stats(profile_path)
+
+    calc_times = {}
+    values = {}
+    for variable in variables:
+        t0 = time.perf_counter()
+        values[variable] = sim.calculate(variable, map_to="household", period=2026)
+        calc_times[variable] = time.perf_counter() - t0
+
+    return {
+        'build_time': build_time,
+        'profile_path': profile_path,
+        'calc_times': calc_times,
+        'values': values,
+    }
+
+def profile_reform_overhead(parallel=False):
+    """Profile the overhead of creating a simulation with reform
 
-def profile_reform_overhead():
-    """Profile the overhead of creating a simulation with reform"""
+    With ``parallel=True`` the baseline and reform pipelines run in two
+    worker processes at once, so wall time is roughly the slower of the two
+    (individual timings may rise slightly from CPU contention).
+    """
 
     print("=" * 80)
     print("PROFILING REFORM SIMULATION OVERHEAD")
     print("=" * 80)
 
-    # Simple household with income variation
-    situation = {
-        "people": {"you": {"age": {2026: 35}}},
-        "families": {"your family": {"members": ["you"]}},
-        "spm_units": {"your household": {"members": ["you"]}},
-        "tax_units": {"your tax unit": {"members": ["you"]}},
-        "households": {
-            "your household": {
-                "members": ["you"],
-                "state_name": {2026: "TX"}
-            }
-        },
-        "axes": [[{
-            "name": "employment_income",
-            "count": 1001,
-            "min": 0,
-            "max": 1000000,
-            "period": 2026
-        }]]
-    }
-
-    # ACA PTC extension reform
-    reform = Reform.from_dict({
-        "gov.aca.ptc_phase_out_rate[0].amount": {"2026-01-01.2100-12-31": 0},
-        "gov.aca.ptc_phase_out_rate[1].amount": {"2025-01-01.2100-12-31": 0},
-        "gov.aca.ptc_phase_out_rate[2].amount": {"2026-01-01.2100-12-31": 0},
-        "gov.aca.ptc_phase_out_rate[3].amount": {"2026-01-01.2100-12-31": 0.02},
-        "gov.aca.ptc_phase_out_rate[4].amount": {"2026-01-01.2100-12-31": 0.04},
-        "gov.aca.ptc_phase_out_rate[5].amount": {"2026-01-01.2100-12-31": 0.06},
-        "gov.aca.ptc_phase_out_rate[6].amount": {"2026-01-01.2100-12-31": 0.085},
-        "gov.aca.ptc_income_eligibility[2].amount": {"2026-01-01.2100-12-31": True}
-    }, country_id="us")
-
-    # Profile baseline
-    print("\n1. Creating baseline simulation...")
-    t0 = time.time()
-    sim_baseline = Simulation(situation=situation)
-    baseline_time = time.time() - t0
-    print(f"   Time: {baseline_time:.3f}s")
-
-    # Profile reform
-    print("\n2. Creating reform simulation...")
-    pr = cProfile.Profile()
-    pr.enable()
-
-    t0 = time.time()
-    sim_reform = Simulation(situation=situation, reform=reform)
-    reform_time = time.time() - t0
-
-    pr.disable()
-
-    print(f"   Time: {reform_time:.3f}s")
+    # Simple household with income variation, and the ACA PTC extension reform
+    jobs = [
+        ("baseline", None, ["employment_income", "aca_ptc"], False),
+        ("reform", REFORM_JSON["US"], ["aca_ptc"], True),
+    ]
+    print(f"\nBuilding and calculating baseline and reform "
+          f"({'in parallel' if parallel else 'one after the other'})...")
+    t0 = time.perf_counter()
+    if parallel:
+        with ProcessPoolExecutor(max_workers=2) as ex:
+            futures = [ex.submit(build_and_calculate, *job) for job in jobs]
+            baseline, reform = [future.result() for future in futures]
+    else:
+        baseline, reform = [build_and_calculate(*job) for job in jobs]
+    wall_time = time.perf_counter() - t0
+    baseline_time = baseline['build_time']
+    reform_time = reform['build_time']
 
     # Summary
     overhead = reform_time - baseline_time
@@ -79,33 +102,45 @@ def profile_reform_overhead():
     print(f"Reform time:     {reform_time:.3f}s")
     print(f"Overhead:        {overhead:.3f}s ({overhead_pct:,.0f}% slower)")
     print(f"Slowdown factor: {reform_time/baseline_time:.1f}x")
+    print(f"Wall time:       {wall_time:.3f}s ({'parallel' if parallel else 'sequential'}, incl. calculations)")
 
     # Top functions by cumulative time
     print("\n" + "=" * 80)
     print("TOP 20 FUNCTIONS BY CUMULATIVE TIME")
     print("=" * 80)
-    stats = pstats.Stats(pr).sort_stats('cumulative')
+    stats = pstats.Stats(reform['profile_path']).sort_stats('cumulative')
     stats.print_stats(20)
+    os.remove(reform['profile_path'])
 
-    # Calculate some variables
+    # Every timed step in one table
     print("\n" + "=" * 80)
-    print("VARIABLE CALCULATIONS")
+    print("TIMINGS")
     print("=" * 80)
 
-    print("\n3. Calculating employment_income...")
-    t0 = time.time()
-    income = sim_baseline.calculate("employment_income", map_to="household", period=2026)
-    print(f"   Time: {time.time()-t0:.3f}s ({len(income)} points)")
-
-    print("\n4. Calculating baseline aca_ptc...")
-    t0 = time.time()
-    ptc_baseline = sim_baseline.calculate("aca_ptc", map_to="household", period=2026)
-    print(f"   Time: {time.time()-t0:.3f}s")
-
-    print("\n5. Calculating reform aca_ptc...")
-    t0 = time.time()
-    ptc_reform = sim_reform.calculate("aca_ptc", map_to="household", period=2026)
-    print(f"   Time: {time.time()-t0:.3f}s")
+    timings = [
+        ("baseline construction", baseline_time, None),
+        ("reform construction", reform_time, None),
+    ]
+    for side, run in (("baseline", baseline), ("reform", reform)):
+        for variable, seconds in run['calc_times'].items():
+            shape = getattr(run['values'][variable], 'shape', None)
+            timings.append((f"{side} {variable}", seconds, shape))
+
+    # Same calculation split over 250-point simulations, for comparison. A
+    # generator, so each chunk is built, calculated and dropped in turn
+    chunk_sims = (
+        Simulation(situation=chunk)
+        for chunk in chunk_situations(build_situation(1001, "US"), 250)
+    )
+    chunk_values, chunk_times = calculate_chunked(chunk_sims, "aca_ptc", period=2026)
+    for i, seconds in enumerate(chunk_times, 1):
+        timings.append((f"baseline aca_ptc chunk {i}", seconds, None))
+    timings.append(("baseline aca_ptc chunked total", sum(chunk_times), chunk_values.shape))
+
+    print()
+    print(pd.DataFrame(timings, columns=["task", "seconds", "shape"]).to_string(
+        index=False, float_format="{:.3f}".format
+    ))
 
     print("\n" + "=" * 80)
     print("RECOMMENDATION")
@@ -123,4 +158,10 @@ Potential fixes:
     """)
 
 if __name__ == "__main__":
-    profile_reform_overhead()
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        "--parallel", action="store_true",
+        help="run the baseline and reform pipelines in two worker processes"
+    )
+    args = parser.parse_args()
+    profile_reform_overhead(parallel=args.parallel)
@@ -0,0 +1,512 @@
+"""
+Shared profiling helpers for the PolicyEngine Profiler app
+"""
+
+import collections
+import copy
+import time
+import functools
+import importlib
+import heapq
+import itertools
+import cProfile
+import json
+import os
+import tempfile
+import threading
+from importlib.metadata import PackageNotFoundError, version
+
+import numpy as np
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:  # memory readings are optional
+    psutil = None
+
+
+def _installed_version(package):
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return None
+
+
+# Looked up once per process: installed versions can't change under a running app
+PACKAGE_VERSIONS = {
+    package: _installed_version(package)
+    for package in ("policyengine-us", "policyengine-core")
+}
+
+# PolicyEngine brand colors (matches policyengine-app)
+COLORS = {
+    "primary": "#2C6496",  # Blue for extension/reform
+    "secondary": "#39C6C0",
+    "green": "#28A745",
+    "gray": "#BDBDBD",  # Medium light gray for baseline
+    "red": "#E57373",  # Light red for warnings/slowdowns
+    "orange": "#FFA726",
+    "blue_gradient": ["#D1E5F0", "#92C5DE", "#2166AC", "#053061"],
+}
+
+
+def build_css(colors):
+    """Build the app stylesheet from the brand colors"""
+    return f"""
+    <style>
+    .stApp {{
+        font-family: 'Roboto', 'Helvetica', 'Arial', sans-serif;
+    }}
+    h1 {{
+        color: {colors["primary"]};
+        font-weight: 600;
+    }}
+    h2 {{
+        color: {colors["primary"]};
+    }}
+    h3 {{
+        color: {colors["primary"]};
+    }}
+    /* Style primary buttons */
+    .stButton > button[kind="primary"] {{
+        background-color: {colors["primary"]};
+        color: white;
+        border: none;
+    }}
+    .stButton > button[kind="primary"]:hover {{
+        background-color: {colors["blue_gradient"][2]};
+        border: none;
+    }}
+    /* Style regular buttons */
+    .stButton > button {{
+        border-color: {colors["primary"]};
+        color: {colors["primary"]};
+    }}
+    .stButton > button:hover {{
+        border-color: {colors["blue_gradient"][2]};
+        color: {colors["blue_gradient"][2]};
+    }}
+    /* Style sliders - surgical approach */
+    /* Hide default red slider elements */
+    .stSlider [data-baseweb="slider"] [data-testid="stThumbValue"] {{
+        color: {colors["primary"]} !important;
+        background-color: {colors["primary"]} !important;
+    }}
+    /* Slider track - filled portion */
+    .stSlider [data-baseweb="slider"] > div > div:first-child {{
+        background-color: {colors["primary"]} !important;
+    }}
+    /* Slider thumb */
+    .stSlider [data-baseweb="slider"] [role="slider"] {{
+        background-color: {colors["primary"]} !important;
+    }}
+    /* Value label text */
+    .stSlider > div > div:first-child > div {{
+        color: {colors["primary"]} !important;
+    }}
+    /* Style selectbox */
+    .stSelectbox > div > div {{
+        border-color: {colors["gray"]};
+    }}
+    /* Style tabs */
+    .stTabs [data-baseweb="tab-list"] button[aria-selected="true"] {{
+        background-color: {colors["primary"]};
+        color: white;
+    }}
+    .stTabs [data-baseweb="tab-list"] button {{
+        color: {colors["primary"]};
+    }}
+    /* Style expandable sections */
+    .streamlit-expanderHeader {{
+        background-color: rgba(44, 100, 150, 0.05);
+        color: {colors["primary"]};
+    }}
+    /* Style checkboxes - target the actual checkbox input */
+    .stCheckbox [data-baseweb="checkbox"] {{
+        background-color: {colors["primary"]} !important;
+        border-color: {colors["primary"]} !important;
+    }}
+    .stCheckbox input[type="checkbox"]:checked ~ div {{
+        background-color: {colors["primary"]} !important;
+    }}
+    .stCheckbox input[type="checkbox"]:checked ~ div svg {{
+        fill: white !important;
+    }}
+    /* Style number input value text */
+    .stNumberInput > div > div > input {{
+        color: {colors["primary"]};
+    }}
+    </style>
+"""
+
+
+# Built once per process: profiler_core is imported once, unlike app.py which
+# Streamlit re-executes on every rerun
+CSS = build_css(COLORS)
+
+
+# Static page text, built once per process rather than on every rerun of app.py
+DOCS_MD = """
+### Purpose
+This tool helps identify performance bottlenecks in PolicyEngine simulations.
+
+### Steps
+1. **Configure** your household and income range in the sidebar
+2. **Choose** whether to profile with a reform
+3. **Click** "Run Profile" to start profiling
+4. **Analyze** the results to identify bottlenecks
+
+### Known Issues
+- **Reform overhead**: Creating a Simulation with a reform is 100-700x slower than baseline
+- **Parameter uprating**: Takes 11+ seconds per reform simulation
+- See [policyengine-core#397](https://github.com/PolicyEngine/policyengine-core/issues/397)
+
+### Tips
+- Start with fewer income points (100-200) for faster profiling
+- Use the detailed profiles to identify specific slow functions
+- Compare baseline vs reform to isolate reform-specific overhead
+"""
+
+FOOTER_HTML = """
+<div style='text-align: center; color: #666;'>
+    <small>PolicyEngine Performance Profiler •
+    <a href='https://github.com/PolicyEngine/policyengine-profiler'>GitHub</a> •
+    <a href='https://github.com/PolicyEngine/policyengine-core/issues/397'>Issue #397</a>
+    </small>
+</div>
+"""
+
+REFORM_SPECS = {
+    "US": {
+        "gov.aca.ptc_phase_out_rate[0].amount": {"2026-01-01.2100-12-31": 0},
+        "gov.aca.ptc_phase_out_rate[1].amount": {"2025-01-01.2100-12-31": 0},
+        "gov.aca.ptc_phase_out_rate[2].amount": {"2026-01-01.2100-12-31": 0},
+        "gov.aca.ptc_phase_out_rate[3].amount": {"2026-01-01.2100-12-31": 0.02},
+        "gov.aca.ptc_phase_out_rate[4].amount": {"2026-01-01.2100-12-31": 0.04},
+        "gov.aca.ptc_phase_out_rate[5].amount": {"2026-01-01.2100-12-31": 0.06},
+        "gov.aca.ptc_phase_out_rate[6].amount": {"2026-01-01.2100-12-31": 0.085},
+        "gov.aca.ptc_income_eligibility[2].amount": {"2026-01-01.2100-12-31": True}
+    },
+    "UK": {
+        "gov.dwp.universal_credit.elements.standard_allowance.amount.single.under_25": {
+            "2024-01-01.2100-12-31": 311.68 * 1.1  # 10% increase
+        }
+    },
+}
+
+
+# Canonical JSON for each default reform, used as a hashable cache key
+REFORM_JSON = {
+    country: json.dumps(spec, sort_keys=True)
+    for country, spec in REFORM_SPECS.items()
+}
+
+
+@functools.lru_cache(maxsize=2)
+def get_simulation_class(country):
+    """Import the country package's Simulation class on first use"""
+    return importlib.import_module(f"policyengine_{country.lower()}").Simulation
+
+
+@functools.lru_cache(maxsize=2)
+def get_system_class(country):
+    """Import the country package's CountryTaxBenefitSystem class on first use"""
+    module = importlib.import_module(f"policyengine_{country.lower()}.system")
+    return module.CountryTaxBenefitSystem
+
+
+@functools.lru_cache(maxsize=32)
+def get_reform(country, reform_json=None):
+    """Get the reform definition based on country (or a JSON-serialised reform dict)
+
+    Memoised: a Reform is a class that is applied to each new system, so one
+    instance can be shared by every Simulation built from it.
+    """
+    from policyengine_core.reforms import Reform
+
+    if reform_json is None:
+        return get_reform(country, REFORM_JSON[country])
+    return Reform.from_dict(json.loads(reform_json), country_id=country.lower())
+
+
+# Standard test households, one income axis each. build_situation copies
+# these and only fills in the varying leaves.
+SITUATION_TEMPLATES = {
+    "US": {
+        "people": {"you": {"age": {2026: 35}}},
+        "families": {"your family": {"members": ["you"]}},
+        "spm_units": {"your household": {"members": ["you"]}},
+        "tax_units": {"your tax unit": {"members": ["you"]}},
+        "households": {
+            "your household": {
+                "members": ["you"],
+                "state_name": {2026: "TX"}
+            }
+        },
+        "axes": [[{
+            "name": "employment_income",
+            "count": 1001,
+            "min": 0,
+            "max": 1000000,
+            "period": 2026
+        }]]
+    },
+    "UK": {
+        "people": {"you": {"age": {2024: 35}}},
+        "benunits": {"your benunit": {"members": ["you"]}},
+        "households": {
+            "your household": {
+                "members": ["you"],
+                "region": {2024: "ENGLAND"}
+            }
+        },
+        "axes": [[{
+            "name": "employment_income",
+            "count": 1001,
+            "min": 0,
+            "max": 100000,
+            "period": 2024
+        }]]
+    },
+}
+
+
+def build_situation(income_points, country, age=None, max_income=None):
+    """Build a standard test situation
+
+    Note: Household config doesn't affect the parameter uprating bottleneck.
+    The 6-7 second overhead happens regardless of age, income, etc.
+    """
+    situation = copy.deepcopy(SITUATION_TEMPLATES[country])
+    axis = situation["axes"][0][0]
+    axis["count"] = income_points
+    if max_income is not None:
+        axis["max"] = max_income
+    if age is not None:
+        ages = situation["people"]["you"]["age"]
+        for year in ages:
+            ages[year] = age
+    return situation
+
+
+def chunk_situations(situation, chunk_size):
+    """Split a situation's income axis into consecutive sub-axes of chunk_size points
+
+    The chunks cover exactly the same income points as the original axis.
+    Only the axes are new; the entity dicts are shared with ``situation``,
+    which is safe because the Simulation builder deep-copies its input.
+    """
+    axis = situation["axes"][0][0]
+    total = axis["count"]
+    step = (axis["max"] - axis["min"]) / max(total - 1, 1)
+    chunks = []
+    for first in range(0, total, chunk_size):
+        count = min(chunk_size, total - first)
+        chunk_axis = dict(
+            axis,
+            count=count,
+            min=axis["min"] + first * step,
+            max=axis["min"] + (first + count - 1) * step,
+        )
+        chunks.append(dict(situation, axes=[[chunk_axis]]))
+    return chunks
+
+
+def calculate_chunked(simulations, variable, period, map_to="household"):
+    """Calculate a variable on each chunk's simulation and stitch the results
+
+    Returns the concatenated values and each chunk's calculation time, so
+    throughput per chunk can be compared with the single-simulation run.
+    ``simulations`` may be a generator that builds each one on demand; only
+    ``calculate()`` is timed, and each simulation is released after use.
+    """
+    values = []
+    times = []
+    for sim in simulations:
+        start = time.perf_counter()
+        values.append(sim.calculate(variable, map_to=map_to, period=period))
+        times.append(time.perf_counter() - start)
+        del sim
+    return np.concatenate(values), times
+
+
+def compare_arrays(base, reform):
+    """Per-point reform minus baseline, reform / baseline, and the RMS difference
+
+    Ratios are 0 where the baseline is 0. Plain vectorised numpy: at a few
+    thousand points this is already microseconds, so a JIT buys nothing.
+    """
+    base = np.asarray(base, dtype=float)
+    reform = np.asarray(reform, dtype=float)
+    diff = reform - base
+    ratio = np.divide(reform, base, out=np.zeros_like(diff), where=base != 0)
+    rms = float(np.sqrt(np.mean(diff * diff))) if diff.size else 0.0
+    return diff, ratio, rms
+
+
+def _rss_bytes():
+    """Resident set size of this process, or None without psutil"""
+    if psutil is None:
+        return None
+    return psutil.Process(os.getpid()).memory_info().rss
+
+
+def _rss_delta_mb(before):
+    after = _rss_bytes()
+    if before is None or after is None:
+        return None
+    return (after - before) / 1e6
+
+
+def time_step(name, func):
+    """Time a single step without any profiler attached"""
+    rss_before = _rss_bytes()
+    start = time.perf_counter_ns()
+    result = func()
+    elapsed = (time.perf_counter_ns() - start) / 1e9
+    return {
+        'name': name,
+        'time': elapsed,
+        'result': result,
+        'profiler': None,
+        'rss_delta_mb': _rss_delta_mb(rss_before)
+    }
+
+
+def profile_step(name, func, sampling=False, full=False):
+    """Profile a single step with timing and cProfile (or a sampling profiler)
+
+    ``func`` runs twice: once unprofiled for the reported wall time (so
+    profiler overhead does not inflate it) and once under the profiler for
+    the stats. With ``sampling=True`` pyinstrument samples the second run
+    instead of cProfile tracing every call, which is much cheaper but gives
+    no call counts. cProfile skips C built-ins and caller edges unless
+    ``full=True``. The raw profiler is returned; render it with
+    ``profile_dataframe`` (cProfile) or ``format_profile`` (sampling).
+    ``rss_delta_mb`` is the resident memory growth over the
+    unprofiled run (None when psutil is not installed).
+    """
+    rss_before = _rss_bytes()
+    start = time.perf_counter_ns()
+    result = func()
+    elapsed = (time.perf_counter_ns() - start) / 1e9
+    rss_delta = _rss_delta_mb(rss_before)
+
+    if sampling:
+        from pyinstrument import Profiler
+
+        pr = Profiler(interval=0.001)
+        pr.start()
+        func()
+        pr.stop()
+    else:
+        pr = cProfile.Profile(subcalls=full, builtins=full)
+        pr.enable()
+        func()
+        pr.disable()
+
+    return {
+        'name': name,
+        'time': elapsed,
+        'result': result,
+        'profiler': pr,
+        'rss_delta_mb': rss_delta
+    }
+
+
+# Recent step results (which hold whole Simulations) by integer handle, so
+# callers such as Streamlit session state keep a small int rather than the
+# objects themselves. Least recently used results are dropped first. The
+# store is per process, so the limit is shared by every Streamlit session:
+# concurrent users can evict each other's results. Session threads call in
+# concurrently, hence the lock.
+MAX_STORED_RESULTS = 4
+_RESULTS = collections.OrderedDict()
+_RESULTS_LOCK = threading.Lock()
+_HANDLES = itertools.count(1)
+
+
+def store_result(result):
+    """Keep a step result and return its handle (the same handle if already kept)"""
+    with _RESULTS_LOCK:
+        for handle, stored in _RESULTS.items():
+            if stored is result:
+                _RESULTS.move_to_end(handle)
+                return handle
+        handle = next(_HANDLES)
+        _RESULTS[handle] = result
+        while len(_RESULTS) > MAX_STORED_RESULTS:
+            _RESULTS.popitem(last=False)
+        return handle
+
+
+def load_result(handle):
+    """The step result for a handle, or None if it has been evicted"""
+    with _RESULTS_LOCK:
+        result = _RESULTS.get(handle)
+        if result is not None:
+            _RESULTS.move_to_end(handle)
+        return result
+
+
+def _function_label(code):
+    """filename:lineno(function) for a profiled code object or built-in"""
+    if isinstance(code, str):
+        return code  # built-ins are recorded by name, e.g. "<built-in method ...>"
+    return f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+
+
+def profile_call_count(pr):
+    """Total number of function calls recorded by a profiler (None if sampled)"""
+    if not isinstance(pr, cProfile.Profile):
+        return None
+    return sum(e.callcount for e in pr.getstats())
+
+
+@functools.lru_cache(maxsize=16)
+def format_profile(pr):
+    """A sampling profile's call tree as text (memoised per profiler)"""
+    return pr.output_text(unicode=True, color=False)
+
+
+@functools.lru_cache(maxsize=16)
+def profile_dataframe(*profilers, limit=50):
+    """Top functions by cumulative time as a sortable DataFrame (memoised per profiler)
+
+    Pass several profilers to get one table across steps; rows for the same
+    function are summed.
+    """
+    totals = {}
+    for pr in profilers:
+        for e in pr.getstats():
+            row = totals.setdefault(_function_label(e.code), [0, 0.0, 0.0])
+            row[0] += e.callcount
+            row[1] += e.inlinetime
+            row[2] += e.totaltime
+    top = heapq.nlargest(limit, totals.items(), key=lambda item: item[1][2])
+    return pd.DataFrame({
+        "function": [label for label, _ in top],
+        "ncalls": [row[0] for _, row in top],
+        "tottime": [row[1] for _, row in top],
+        "cumtime": [row[2] for _, row in top],
+    })
+
+
+@functools.lru_cache(maxsize=16)
+def export_profile(pr):
+    """Raw profile for download as ``(data, file extension)``
+
+    cProfile profiles are the marshalled .prof format (open with snakeviz or
+    ``python -m pstats``); sampling profiles are pyinstrument's interactive
+    HTML report.
+    """
+    if not isinstance(pr, cProfile.Profile):
+        return pr.output_html().encode(), "html"
+    fd, path = tempfile.mkstemp(suffix=".prof")
+    os.close(fd)
+    try:
+        pr.dump_stats(path)
+        with open(path, "rb") as f:
+            return f.read(), "prof"
+    finally:
+        os.remove(path)
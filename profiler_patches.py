@@ -0,0 +1,83 @@
+"""
+Opt-in patches for PolicyEngine hot paths, for what-if profiling
+
+These never run by default: the profiler's job is to measure stock
+PolicyEngine. Enable them to see how much a fix would save.
+"""
+
+import contextlib
+import functools
+import sys
+
+# policyengine_core.periods.helpers functions replaced by patched_periods()
+PATCHED_HELPERS = ("instant", "period")
+
+# Period strings parameter files and reforms use: every year, month and
+# month-start day from 1900 to 2149
+COMMON_PERIOD_KEYS = tuple(
+    key
+    for year in range(1900, 2150)
+    for key in (
+        str(year),
+        *(f"{year}-{month:02d}" for month in range(1, 13)),
+        *(f"{year}-{month:02d}-01" for month in range(1, 13)),
+    )
+)
+
+
+def memoise_helper(original, maxsize=65536):
+    """Wrap a periods helper so repeated inputs skip re-parsing
+
+    Instants and periods are immutable, so returning a cached one is safe.
+    Unhashable inputs (e.g. lists) fall through to the original function.
+    """
+    cached = functools.lru_cache(maxsize=maxsize)(original)
+
+    @functools.wraps(original)
+    def helper(value):
+        try:
+            return cached(value)
+        except TypeError:
+            return original(value)
+
+    return helper
+
+
+@functools.lru_cache(maxsize=None)
+def fast_helpers():
+    """Build the memoised helpers once per process, pre-filled with COMMON_PERIOD_KEYS"""
+    from policyengine_core.periods import helpers
+
+    fast = {}
+    for name in PATCHED_HELPERS:
+        fast[name] = memoise_helper(getattr(helpers, name))
+        for key in COMMON_PERIOD_KEYS:
+            fast[name](key)
+    return fast
+
+
+@contextlib.contextmanager
+def patched_periods():
+    """Temporarily replace policyengine_core's instant()/period() with memoised ones
+
+    Modules that did ``from ... import instant`` hold their own reference,
+    so every loaded policyengine module bound to an original is patched.
+    """
+    from policyengine_core.periods import helpers
+
+    fast = fast_helpers()
+    patched = []
+    for name in PATCHED_HELPERS:
+        original = getattr(helpers, name)
+        for module_name, module in list(sys.modules.items()):
+            if (
+                module_name.startswith("policyengine")
+                and getattr(module, name, None) is original
+            ):
+                setattr(module, name, fast[name])
+                patched.append((module, name, original))
+    try:
+        yield
+    finally:
+        for module, name, original in patched:
+            setattr(module, name, original)